@@ -1,9 +1,15 @@
 import chess
 import chess.engine
+import heapq
+import os
 import requests
 import sys
 
 engine = chess.engine.SimpleEngine.popen_uci("/usr/bin/stockfish")
+engine.configure({"Threads": os.cpu_count(), "Hash": 1024})
+
+# search budget for each line of a MultiPV analysis
+NODES_PER_MOVE = 2_000_000
 
 
 def get_moves_table(board):
@@ -30,11 +36,17 @@ def get_moves_table(board):
     return table
 
 
-def analyse_move(board, move):
-    board.push(move)
-    score = engine.analyse(board, chess.engine.Limit(depth=15))
-    board.pop()
-    return score["score"]
+# Scores every legal move with a single MultiPV search, so sibling moves
+# share the engine's transposition table
+def analyse_moves(board):
+    count = board.legal_moves.count()
+
+    if count == 0:
+        return []
+
+    limit = chess.engine.Limit(nodes=NODES_PER_MOVE * count)
+    infos = engine.analyse(board, limit, multipv=count)
+    return [(info["pv"][0], info["score"]) for info in infos]
 
 
 # the value of the 2nd best move against
@@ -43,10 +55,8 @@ def analyse_move(board, move):
 def score(board):
     table = get_moves_table(board)
 
-    scores = (
-        (m.uci(), analyse_move(board, m).pov(not board.turn)) for m in board.legal_moves
-    )
-    scores = sorted(scores, key=lambda x: x[1])
+    scores = [(m.uci(), s.pov(not board.turn)) for m, s in analyse_moves(board)]
+    scores = heapq.nsmallest(2, scores, key=lambda x: x[1])
 
     # we default to 1, rather than zero, as the 1st move could
     # be such an obvious blunder that no one has ever played it
@@ -57,8 +67,14 @@ def score(board):
     if scores[0][1].is_mate():
         return 0.0
 
-    exp_1 = scores[0][1].wdl(model="sf12", ply=board.ply()).winning_chance()
-    exp_2 = scores[0][1].wdl(model="sf12", ply=board.ply()).winning_chance()
+    ply = board.ply()
+    exp_1 = scores[0][1].wdl(model="sf12", ply=ply).winning_chance()
+
+    # with only one legal reply there is no second best move to fall into
+    if len(scores) > 1:
+        exp_2 = scores[1][1].wdl(model="sf12", ply=ply).winning_chance()
+    else:
+        exp_2 = exp_1
 
     return correct_probability * exp_1 + (1 - correct_probability) * exp_2
 
@@ -75,6 +91,9 @@ def score(board):
 def find_best_move(board):
     moves = []
 
+    # searching the parent first leaves the hash warm for each reply's search
+    engine.analyse(board, chess.engine.Limit(depth=12))
+
     for m in board.legal_moves:
         board.push(m)
         print(f"vs {m} ", end="")
@@ -82,22 +101,18 @@ def find_best_move(board):
         sys.stdout.flush()
         board.pop()
 
-    moves = sorted(moves, key=lambda x: -x[1])
-    print("allow_one:" + str(moves[:3]))
+    print("allow_one:" + str(heapq.nlargest(3, moves, key=lambda x: x[1])))
 
 # This strategy uses sf12s win/draw/loss model and chooses the move with the
 # best chance of a win (don't play for a draw)
 def find_winningest_move(board):
-    moves = (
+    moves = [
         (
             m.uci(),
-            analyse_move(board, m)
-            .pov(board.turn)
-            .wdl(model="sf12", ply=board.ply())
-            .winning_chance(),
+            s.pov(board.turn).wdl(model="sf12", ply=board.ply()).winning_chance(),
         )
-        for m in board.legal_moves
-    )
+        for m, s in analyse_moves(board)
+    ]
 
     moves = sorted(moves, key=lambda x: -x[1])
     print("winningest:" + str(moves[:3]))
@@ -106,17 +121,12 @@ def find_winningest_move(board):
 # This strategy uses sf12s win/draw/loss model and chooses the move with the
 # best chance of a win or a draw
 def find_dontlose_move(board):
-    moves = (
-        (
-            m.uci(),
-            analyse_move(board, m)
-            .pov(board.turn)
-            .wdl(model="sf12", ply=board.ply())
-        )
-        for m in board.legal_moves
-    )
+    wdls = [
+        (m.uci(), s.pov(board.turn).wdl(model="sf12", ply=board.ply()))
+        for m, s in analyse_moves(board)
+    ]
 
-    moves = ((m, s.winning_chance() + s.drawing_chance()) for m, s in moves)
+    moves = [(m, s.winning_chance() + s.drawing_chance()) for m, s in wdls]
 
     moves = sorted(moves, key=lambda x: -x[1])
     print("dontlose:" + str(moves[:3]))
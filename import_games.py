@@ -0,0 +1,222 @@
+# Builds explorer tables from a Lichess database dump so that openings.py can
+# answer them from its cache instead of the rate limited explorer API.
+#
+#   zstdcat lichess_db_standard_rated_2021-01.pgn.zst | python import_games.py
+#
+# Tables are written to the same cache (EXPLORER_CACHE), under keys of their
+# own, and openings.py reads them instead of the explorer when run with
+# EXPLORER_SOURCE=import:
+#
+#   EXPLORER_SOURCE=import python openings.py licw
+#
+# A dump has far fewer games than the explorer, so the two sources are never
+# mixed in one run; counts from one would rank badly against the other.
+# Positions below --min-games aren't written, and are treated as having no
+# games. Masters tables still come from the explorer.
+#
+# A build needs move tables up to ply max_ply + 1 (max_ply + color + 1, with
+# color 1 for white), so --max-ply must be at least that. The default covers
+# openings.py's MAX_PLY of 24 for either colour; stkw/stkb build to ply 30,
+# so need --max-ply 32.
+import argparse
+import collections
+import logging
+import os
+import sys
+import chess
+import chess.pgn
+import diskcache
+
+logging.basicConfig(level=logging.INFO)
+
+# Lichess' speed categories, by estimated game duration (base + 40 * increment)
+SPEED_LIMITS = (
+    ("ultraBullet", 30),
+    ("bullet", 180),
+    ("blitz", 480),
+    ("rapid", 1500),
+    ("classical", 21600),
+)
+RATING_BUCKETS = (0, 1000, 1200, 1400, 1600, 1800, 2000, 2200, 2500)
+RESULTS = {"1-0": 0, "1/2-1/2": 1, "0-1": 2}
+
+
+def speed(time_control):
+    if time_control == "-":
+        return "correspondence"
+
+    base, _, increment = time_control.partition("+")
+    estimate = int(base) + 40 * int(increment or 0)
+
+    for name, limit in SPEED_LIMITS:
+        if estimate < limit:
+            return name
+
+    return "correspondence"
+
+
+# The explorer buckets games by the average rating of both players
+def rating_bucket(headers):
+    try:
+        average = (int(headers["WhiteElo"]) + int(headers["BlackElo"])) // 2
+    except (KeyError, ValueError):
+        return None
+
+    return max((r for r in RATING_BUCKETS if r <= average), default=None)
+
+
+def wanted(headers, speeds, ratings):
+    if headers.get("Result") not in RESULTS:
+        return False
+
+    try:
+        if speed(headers.get("TimeControl", "-")) not in speeds:
+            return False
+    except ValueError:
+        return False
+
+    return rating_bucket(headers) in ratings
+
+
+# Skips the movetext of games outside the requested speeds and ratings, which
+# is most of the cost of reading a dump
+class FilteredGameBuilder(chess.pgn.GameBuilder):
+    def __init__(self, speeds, ratings):
+        super().__init__()
+        self.speeds = speeds
+        self.ratings = ratings
+        self.skipped = False
+
+    def end_headers(self):
+        if not wanted(self.game.headers, self.speeds, self.ratings):
+            self.skipped = True
+            return chess.pgn.SKIP
+
+        return None
+
+
+def new_entry():
+    return {"totals": [0, 0, 0], "moves": collections.defaultdict(lambda: [0, 0, 0])}
+
+
+# Almost every position deep in a game is seen only once, so rather than
+# holding all of them the rarest are dropped whenever there are too many.
+# A dropped position that turns up again starts counting from zero, so the
+# counts of rare positions are undercounted; popular ones are kept from
+# their first games on
+def drop_rare(positions, floor):
+    for epd in [epd for epd, e in positions.items() if sum(e["totals"]) < floor]:
+        del positions[epd]
+
+
+def count_games(pgn, speeds, ratings, max_ply, max_positions):
+    positions = collections.defaultdict(new_entry)
+    games = 0
+    floor = 2
+
+    while True:
+        builder = FilteredGameBuilder(speeds, ratings)
+
+        if (game := chess.pgn.read_game(pgn, Visitor=lambda: builder)) is None:
+            break
+
+        if builder.skipped or game.errors:
+            continue
+
+        result = RESULTS[game.headers["Result"]]
+        board = game.board()
+
+        # positions up to and including max_ply get their totals and moves
+        for move in game.mainline_moves():
+            if board.ply() > max_ply:
+                break
+
+            entry = positions[board.epd()]
+            entry["totals"][result] += 1
+            entry["moves"][board.uci(move)][result] += 1
+            board.push(move)
+
+        # a game that ended in range still counts towards its final position
+        if board.ply() <= max_ply:
+            positions[board.epd()]["totals"][result] += 1
+
+        games += 1
+
+        if len(positions) > max_positions:
+            drop_rare(positions, floor)
+            logging.info("Dropped positions seen under %d times", floor)
+
+            # raise the bar if that didn't free enough to be worth it
+            if len(positions) > max_positions // 2:
+                floor *= 2
+
+        if games % 10_000 == 0:
+            logging.info("%d games, %d positions...", games, len(positions))
+
+    return positions, games
+
+
+# Same shape as the explorer's response, as far as openings.py reads it
+def explorer_response(entry, top_moves):
+    moves = sorted(entry["moves"].items(), key=lambda kv: -sum(kv[1]))[:top_moves]
+    white, draws, black = entry["totals"]
+
+    return {
+        "white": white,
+        "draws": draws,
+        "black": black,
+        "moves": [
+            {"uci": uci, "white": w, "draws": d, "black": b}
+            for uci, (w, d, b) in moves
+        ],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("pgn", nargs="?", help="PGN file, read from stdin if omitted")
+    parser.add_argument("--speeds", nargs="+", default=["blitz", "rapid", "classical"])
+    parser.add_argument("--ratings", nargs="+", type=int, default=[1600])
+    # openings.py's MAX_PLY + 2
+    parser.add_argument("--max-ply", type=int, default=26)
+    parser.add_argument("--min-games", type=int, default=200)
+    parser.add_argument("--top-moves", type=int, default=10)
+    parser.add_argument("--max-positions", type=int, default=5_000_000)
+    args = parser.parse_args()
+
+    pgn = open(args.pgn) if args.pgn else sys.stdin
+
+    with pgn:
+        positions, games = count_games(
+            pgn, set(args.speeds), set(args.ratings), args.max_ply, args.max_positions
+        )
+
+    logging.info("Read %d games, %d positions", games, len(positions))
+
+    # must match the keys openings.py reads imported tables from
+    speeds = tuple(args.speeds)
+    ratings = tuple(args.ratings)
+
+    cache = diskcache.Cache(os.environ.get("EXPLORER_CACHE", ".explorer_cache"))
+    written = 0
+
+    with cache.transact():
+        # replaces an earlier import with the same filters, rather than
+        # leaving its positions that this one didn't write
+        for key in list(cache):
+            if key[0] == "import" and key[2:] == (speeds, ratings):
+                del cache[key]
+
+        for epd, entry in positions.items():
+            if sum(entry["totals"]) < args.min_games:
+                continue
+
+            key = ("import", epd, speeds, ratings)
+            cache.set(key, explorer_response(entry, args.top_moves))
+            written += 1
+
+    logging.info("Wrote %d positions to %s", written, cache.directory)
+
+
+if __name__ == "__main__":
+    main()
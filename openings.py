@@ -1,58 +1,254 @@
 import collections
+import contextlib
 import sys
 import functools
-import requests
-import queue
+import heapq
 import chess
 import chess.engine
 import chess.pgn
+import chess.polyglot
 import logging
+import multiprocessing
 import time
 import math
+import os
+import queue
+import threading
+import diskcache
+import httpx
+from concurrent.futures import ThreadPoolExecutor, wait as wait_for_futures
 
 logging.basicConfig(level=logging.INFO)
+logging.getLogger("httpx").setLevel(logging.WARNING)
 
 # 14 = 14/2 = 7 for black, 8 for white
 MAX_PLY = 24
 
-engine = chess.engine.SimpleEngine.popen_uci("/usr/bin/stockfish")
-session = requests.Session()
+# When moves are chosen from explorer tables, replies with fewer games than
+# this end the line rather than being answered, since finding a move there
+# mostly means falling back to stockfish
+MIN_REPLY_GAMES = 50
+
+# An opt-in, lossy cutoff for find_best_move: once a candidate scores about
+# as well as the position itself, the less played candidates are skipped if
+# together they're played less than this share of the time. How often a move
+# is played doesn't bound how well it scores, so a skipped move may have been
+# the best one. 0, the default, scores every candidate
+SKIP_UNPOPULAR_SHARE = 0
+
+# A node budget rather than a fixed depth, so sharp positions can't blow up
+# the time spent on a single analysis
+ANALYSIS_NODES = 2_000_000
+SEED_DEPTH = 12
+
+ENGINE_HASH = 4096
+# One engine keeps the whole hash warm across a position's searches. More
+# run sibling searches side by side, each with a share of the cores and hash
+ENGINE_COUNT = int(os.environ.get("ENGINES", "1"))
+WORKERS = int(os.environ.get("WORKERS", "1"))
+
+
+def start_engine(threads, hash_mb=ENGINE_HASH):
+    eng = chess.engine.SimpleEngine.popen_uci("/usr/bin/stockfish")
+    eng.configure({"Threads": threads, "Hash": hash_mb})
+    return eng
+
+
+# Independent analyses run side by side on a pool of engines, which split the
+# cores and hash between them
+def start_engines(count, threads, hash_mb):
+    global engines, idle_engines
 
+    engines = [start_engine(threads, hash_mb) for _ in range(count)]
+    idle_engines = queue.Queue()
 
-def winning(board, pov, depth=15):
-    score = engine.analyse(board, chess.engine.Limit(depth=depth))
-    return score["score"].pov(pov)
+    for eng in engines:
+        idle_engines.put(eng)
+
+
+def stop_engines():
+    global engines, idle_engines
+
+    for eng in engines:
+        eng.quit()
+
+    engines = []
+    idle_engines = queue.Queue()
+
+
+def start_main_engines():
+    start_engines(
+        ENGINE_COUNT, max(1, os.cpu_count() // ENGINE_COUNT), ENGINE_HASH // ENGINE_COUNT
+    )
+
+
+@contextlib.contextmanager
+def borrowed_engine():
+    eng = idle_engines.get()
+    try:
+        yield eng
+    finally:
+        idle_engines.put(eng)
+
+
+def new_client():
+    return httpx.Client(
+        timeout=10.0,
+        transport=httpx.HTTPTransport(
+            http2=True,
+            retries=3,
+            limits=httpx.Limits(max_connections=20, max_keepalive_connections=20),
+        ),
+    )
+
+
+start_main_engines()
+client = new_client()
+explorer_cache = diskcache.Cache(os.environ.get("EXPLORER_CACHE", ".explorer_cache"))
+# kept next to the explorer data so later runs (e.g. with a higher MAX_PLY)
+# reuse earlier searches
+best_moves = diskcache.Cache(os.path.join(explorer_cache.directory, "best_moves"))
+# Part of every best_moves key. Bump it whenever a heuristic or move finder
+# changes what it picks, so answers saved by older code aren't served
+BEST_MOVES_VERSION = 5
+
+DEFAULT_SPEEDS = ("blitz", "rapid", "classical")
+DEFAULT_RATINGS = (1600,)
+
+REQUESTS_PER_SECOND = 15
+PREFETCH_WORKERS = 8
+BACKGROUND_PREFETCHES = 4
+RETRY_STATUSES = (429, 502, 503)
+EXPLORER_ATTEMPTS = 5
+EXPLORER_CACHE_MAX_AGE = 30 * 24 * 60 * 60
+
+# EXPLORER_SOURCE=import answers lichess tables only from those written by
+# import_games.py, and never from the explorer. Its counts come from far fewer
+# games than the explorer's, so the two are never mixed in one run. Positions
+# it didn't import have no games
+EXPLORER_SOURCE = os.environ.get("EXPLORER_SOURCE", "api")
+IMPORTED_TABLES = EXPLORER_SOURCE == "import"
+EMPTY_TABLE = {"white": 0, "draws": 0, "black": 0, "moves": []}
+
+_heuristic_cache = {}
+_eval_cache = {}
+
+_rate_lock = threading.Lock()
+_next_request = 0.0
+_request_interval = 1 / REQUESTS_PER_SECOND
+
+# python-chess sends ucinewgame whenever the game passed to analyse changes,
+# so related analyses share one game and keep the engine's hash table
+analysis_game = object()
+
+
+def new_analysis_game():
+    global analysis_game
+    analysis_game = object()
+
+
+# Evaluations are cached by position, so transpositions skip the search
+def winning(board, pov, depth=None):
+    key = (chess.polyglot.zobrist_hash(board), depth)
+
+    if (score := _eval_cache.get(key)) is None:
+        if depth:
+            limit = chess.engine.Limit(depth=depth)
+        else:
+            limit = chess.engine.Limit(nodes=ANALYSIS_NODES)
+
+        with borrowed_engine() as eng:
+            score = eng.analyse(board, limit, game=analysis_game)["score"]
+
+        _eval_cache[key] = score
+
+    return score.pov(pov)
+
+
+# A shallow search of the parent fills the hash with entries that the
+# searches of each of its children can reuse. With several engines the
+# children are searched on engines other than the one seeded, so skip it
+def seed_hash(board):
+    if len(engines) > 1:
+        return
+
+    with borrowed_engine() as eng:
+        eng.analyse(board, chess.engine.Limit(depth=SEED_DEPTH), game=analysis_game)
+
+
+# score(child) for the position after each move, spread across the engines
+def score_children(board, moves, score):
+    # with nothing to run alongside, reuse the board rather than copying it
+    if len(engines) == 1:
+        scores = []
+
+        for m in moves:
+            board.push(m)
+            try:
+                scores.append((m, score(board)))
+            finally:
+                board.pop()
+
+        return scores
+
+    def score_child(m):
+        child = board.copy()
+        child.push(m)
+        return m, score(child)
+
+    with ThreadPoolExecutor(max_workers=len(engines)) as ex:
+        return list(ex.map(score_child, moves))
 
 
 def prune_candidates(candidates, board, pov, depth, prune):
-    scores = []
-    for c in candidates:
-        board_copy = board.copy()
-        board_copy.push(c)
-        score = winning(board_copy, pov=pov, depth=depth)
-        scores.append((c, score))
+    scores = score_children(
+        board, candidates, lambda b: winning(b, pov=pov, depth=depth)
+    )
+
+    return [m for m, _ in heapq.nlargest(prune, scores, key=lambda s: s[1])]
+
 
-    scores = sorted(scores, key=lambda s: -s[1])
-    return [s[0] for s in scores][:prune]
+def easy_stockfish(board, *args, **kwargs):
+    # forced replies need no search
+    if len(legal := list(board.legal_moves)) == 1:
+        return legal[0]
 
+    new_analysis_game()
+    pov = board.turn
 
-def easy_stockfish(board, pov, *args, **kwargs):
-    candidates = board.legal_moves
+    # a quick shallow pass picks the candidates, then one MultiPV search
+    # restricted to them replaces a cascade of ever deeper searches
+    candidates = prune_candidates(legal, board, pov=pov, depth=3, prune=5)
 
-    candidates = prune_candidates(candidates, board, pov, 3, 5)
-    candidates = prune_candidates(candidates, board, pov, 6, 4)
-    candidates = prune_candidates(candidates, board, pov, 9, 3)
-    candidates = prune_candidates(candidates, board, pov, 12, 2)
-    candidates = prune_candidates(candidates, board, pov, 15, 1)
+    with borrowed_engine() as eng:
+        infos = eng.analyse(
+            board,
+            chess.engine.Limit(depth=15),
+            multipv=len(candidates),
+            root_moves=candidates,
+            game=analysis_game,
+        )
 
-    return candidates[0]
+    best = max(infos, key=lambda i: i["score"].pov(pov).score(mate_score=10000))
+    return best["pv"][0]
 
 
+# A single depth 15 search reports its score at every depth on the way, so
+# the shallower scores come from that rather than separate searches
 def stockfish(board, pov):
-    scores = [
-        engine.analyse(board, chess.engine.Limit(depth=d))["score"].pov(pov).score(mate_score=10000)
-        for d in (5, 10, 15)
-    ]
+    by_depth = {}
+
+    with borrowed_engine() as eng:
+        with eng.analysis(board, chess.engine.Limit(depth=15), game=analysis_game) as analysis:
+            for info in analysis:
+                if "score" in info and "depth" in info:
+                    by_depth[info["depth"]] = info["score"]
+
+    def score_at(depth):
+        reached = max(d for d in by_depth if d <= depth)
+        return by_depth[reached].pov(pov).score(mate_score=10000)
+
+    scores = [score_at(d) for d in (5, 10, 15)]
 
     return sum(a * b for a, b in zip(scores, (3, 2, 1)))
 
@@ -72,7 +268,7 @@ def winrate(board, pov, get_moves_table):
     if board.is_checkmate():
         return 1.0 if board.turn != pov else 0.0
 
-    r = get_moves_table(board.fen())
+    r = get_moves_table(board.epd())
 
     total = r["white"] + r["black"] + r["draws"]
     wins = r["white"] if pov == chess.WHITE else r["black"]
@@ -85,19 +281,37 @@ def winrate(board, pov, get_moves_table):
 
 def wsi_lower(wins, total):
     z = 1.96
+    z2 = z * z
     phat = wins / total
-    n = total
 
-    a = phat + z * z / (2 * total)
-    b = z * math.sqrt((phat * (1 - phat) + z * z / (4 * total)) / total)
-    c = 1 + z * z / total
+    a = phat + z2 / (2 * total)
+    b = z * math.sqrt((phat * (1 - phat) + z2 / (4 * total)) / total)
+    c = 1 + z2 / total
 
     return (a - b) / c
 
 
+# Heuristics only depend on the position, so transpositions share a score
+def cached_heuristic(heuristic, board, pov):
+    key = (chess.polyglot.zobrist_hash(board), pov, heuristic.__name__)
+
+    if (score := _heuristic_cache.get(key)) is None:
+        score = heuristic(board, pov)
+        _heuristic_cache[key] = score
+
+    return score
+
+
 def find_best_move(board, heuristic, *args, **kwargs):
+    # forced replies need neither the explorer nor the engine
+    if len(legal := list(board.legal_moves)) == 1:
+        return legal[0]
+
+    new_analysis_game()
+
     min_pct = 0.05
-    before = heuristic(board, board.turn)
+    pov = board.turn
+    before = cached_heuristic(heuristic, board, pov)
 
     moves = []
 
@@ -108,21 +322,28 @@ def find_best_move(board, heuristic, *args, **kwargs):
     ]
 
     if len(pass_pct) >= 3:
-        candidates = sorted(pass_pct, key=lambda k: -table[k][0])[:5]
+        candidates = heapq.nlargest(5, pass_pct, key=lambda k: table[k][0])
     else:
-        candidates = sorted(table.keys(), key=lambda k: -table[k][0])[:3]
-
-    for m in candidates:
-        board_copy = board.copy()
-        board_copy.push(m)
-        moves.append((m, heuristic(board_copy, board.turn)))
+        candidates = heapq.nlargest(3, table, key=lambda k: table[k][0])
 
     top_score = 0.0
 
-    if moves:
-        top_score = sorted(moves, key=lambda x: -x[1])[0][1]
+    # candidates are in order of popularity, so what's left after each one is
+    # the less played moves (see SKIP_UNPOPULAR_SHARE)
+    for i, m in enumerate(candidates):
+        board.push(m)
+        try:
+            moves.append((m, cached_heuristic(heuristic, board, pov)))
+        finally:
+            board.pop()
+
+        top_score = max(top_score, moves[-1][1])
+        remaining_share = sum(table[k][0] for k in candidates[i + 1:])
+
+        if top_score >= 0.98 * before and remaining_share < SKIP_UNPOPULAR_SHARE:
+            break
 
-    not_enough_candidates = len(moves) < 2
+    not_enough_candidates = len(candidates) < 2
     unusual_drop = top_score < 0.95 * before
     unusually_low = top_score - before > 0.01 and top_score < 0.45
 
@@ -130,91 +351,210 @@ def find_best_move(board, heuristic, *args, **kwargs):
         logging.info(
             "Falling back to stockfish (%f) for %s", top_score - before, board.fen()
         )
-        for m in board.legal_moves:
-            board_copy = board.copy()
-            board_copy.push(m)
-
-            sf = (
-                winning(board_copy, board.turn)
-                .wdl(model="lichess", ply=board_copy.ply())
-                .winning_chance()
+        seed_hash(board)
+
+        moves.extend(
+            score_children(
+                board,
+                legal,
+                lambda b: winning(b, pov).wdl(model="lichess", ply=b.ply()).winning_chance(),
             )
-            moves.append((m, sf))
+        )
+
+    return max(moves, key=lambda x: x[1])[0]
+
+
+# Spaces requests out so that concurrent fetches stay under the explorer's
+# rate limit
+def rate_limit():
+    global _next_request
+
+    with _rate_lock:
+        now = time.monotonic()
+        wait = _next_request - now
+        _next_request = max(now, _next_request) + _request_interval
+
+    if wait > 0:
+        time.sleep(wait)
+
+
+# After a 429 the explorer wants every request held back, not just the one
+# that got it, so push the next slot out for all threads
+def pause_requests(seconds):
+    global _next_request
+
+    with _rate_lock:
+        _next_request = max(_next_request, time.monotonic() + seconds)
+
+
+# Each process that makes requests gets an equal share of the rate limit
+def share_rate_limit(shares):
+    global _rate_lock, _request_interval
+
+    _rate_lock = threading.Lock()
+    _request_interval = shares / REQUESTS_PER_SECOND
+
+
+def retry_after(rsp, default=60):
+    try:
+        return float(rsp.headers.get("Retry-After", default))
+    except ValueError:
+        return default
+
 
-    return sorted(moves, key=lambda x: -x[1])[0][0]
+# Returns the decoded response, or raises once retries are exhausted so that
+# failures are never cached
+def explorer_get(url, params):
+    for attempt in range(EXPLORER_ATTEMPTS):
+        last_attempt = attempt == EXPLORER_ATTEMPTS - 1
+        wait = min(60, 2 ** attempt)
+
+        rate_limit()
+        try:
+            rsp = client.get(url, params=params)
+        except httpx.TransportError as e:
+            if last_attempt:
+                raise
+
+            logging.warning("explorer request failed: %s", e)
+        else:
+            if rsp.status_code not in RETRY_STATUSES or last_attempt:
+                rsp.raise_for_status()
+                return rsp.json()
+
+            if rsp.status_code == 429:
+                wait = retry_after(rsp)
+                logging.info("Pausing %.0fs for rate limit...", wait)
+
+                # rate_limit() does the waiting, for this thread and the rest
+                pause_requests(wait)
+                continue
+
+        time.sleep(wait)
+
+
+# Entries older than the max age are refetched, but still used if the
+# explorer can't be reached
+def cached_explorer_get(key, url, params):
+    cached = explorer_cache.get(key)
+
+    if cached is not None:
+        fetched_at, r = cached
+        if time.time() - fetched_at < EXPLORER_CACHE_MAX_AGE:
+            return r
+
+    try:
+        r = explorer_get(url, params)
+    except httpx.HTTPError as e:
+        if cached is None:
+            raise
+
+        logging.warning("using stale explorer data for %s: %s", params["fen"], e)
+        return cached[1]
+
+    explorer_cache.set(key, (time.time(), r))
+    return r
+
+
+# The explorer ignores the halfmove clock and fullmove number, so drop them
+# to share cache entries between transpositions. Where there's a board to
+# hand, board.epd() gives the same four fields directly
+def explorer_fen(fen):
+    return " ".join(fen.split()[:4])
 
 
-@functools.cache
 def get_moves_table_fen(fen, speeds=None, ratings=None):
-    speeds = speeds or ["blitz", "rapid", "classical"]
-    ratings = ratings or [1600]
+    return _get_moves_table_fen(
+        explorer_fen(fen),
+        tuple(speeds or DEFAULT_SPEEDS),
+        tuple(ratings or DEFAULT_RATINGS),
+    )
+
+
+@functools.lru_cache(maxsize=4096)
+def _get_moves_table_fen(fen, speeds, ratings):
+    if IMPORTED_TABLES:
+        return explorer_cache.get(("import", fen, speeds, ratings), EMPTY_TABLE)
+
+    key = ("lichess", fen, speeds, ratings)
 
     params = {
-        "fen": fen,
+        "fen": fen + " 0 1",
         "moves": 10,
         "topGames": 0,
         "recentGames": 0,
         "variant": "standard",
-        "speeds[]": speeds,
-        "ratings[]": ratings,
+        "speeds[]": list(speeds),
+        "ratings[]": list(ratings),
     }
 
-    retry_count = 0
-    while retry_count < 3:
-        rsp = None  # default to something for exception logging
-        try:
-            rsp = session.get("https://explorer.lichess.ovh/lichess", params=params)
-            if rsp.status_code == 429:
-                logging.info("Pausing for rate limit...")
-                time.sleep(60)
-            else:
-                return rsp.json()
-        except:
-            logging.warning("response: %s", rsp)
+    return cached_explorer_get(key, "https://explorer.lichess.ovh/lichess", params)
 
-            logging.info("Pausing before retry...")
-            time.sleep(300)
 
-        retry_count += 1
+def get_masters_table_fen(fen):
+    return _get_masters_table_fen(explorer_fen(fen))
 
 
-@functools.cache
-def get_masters_table_fen(fen):
+@functools.lru_cache(maxsize=4096)
+def _get_masters_table_fen(fen):
+    key = ("masters", fen)
+
     params = {
-        "fen": fen,
+        "fen": fen + " 0 1",
         "moves": 15,
         "topGames": 0,
         "recentGames": 0,
         "variant": "standard",
     }
 
+    return cached_explorer_get(key, "https://explorer.lichess.ovh/master", params)
+
+
+def prefetch_moves_table(fen):
     try:
-        rsp = session.get("https://explorer.lichess.ovh/master", params=params)
-        if rsp.status_code == 429:
-            logging.info("Pausing for rate limit...")
-            time.sleep(60)
-            rsp = session.get("https://explorer.lichess.ovh/master", params=params)
+        get_moves_table_fen(fen)
+    except httpx.HTTPError as e:
+        # left for the caller to retry when it actually needs the table
+        logging.warning("prefetch failed for %s: %s", fen, e)
+
+
+def prefetch_moves_tables(fens):
+    with ThreadPoolExecutor(max_workers=PREFETCH_WORKERS) as ex:
+        list(ex.map(prefetch_moves_table, set(fens)))
+
 
-        return rsp.json()
-    except:
-        logging.warning("response: %s", rsp)
+# callers that already hold the board's EPD can pass it to save rebuilding it
+def get_moves_table(board, min_moves=200, epd=None):
+    total_moves, table = _moves_table(epd or board.epd())
 
+    if total_moves < min_moves:
+        return {}
+
+    return table
 
-def get_moves_table(board, min_moves=200):
-    r = get_moves_table_fen(board.fen())
+
+# shared between callers, so treat the returned table as read only
+@functools.lru_cache(maxsize=8192)
+def _moves_table(fen):
+    r = get_moves_table_fen(fen)
 
     total_moves = r["white"] + r["black"] + r["draws"]
 
     table = {}
 
-    if total_moves < min_moves:
-        return table
-
     for move in r["moves"]:
         count = move["white"] + move["black"] + move["draws"]
-        table[chess.Move.from_uci(move["uci"])] = (count / total_moves, count)
+        table[explorer_move(move["uci"])] = (count / total_moves, count)
 
-    return table
+    return total_moves, table
+
+
+# Explorer moves are always well formed, so skip Move.from_uci's checks
+def explorer_move(uci):
+    promotion = chess.PIECE_SYMBOLS.index(uci[4]) if len(uci) > 4 else None
+    return chess.Move(
+        chess.parse_square(uci[0:2]), chess.parse_square(uci[2:4]), promotion
+    )
 
 
 def get_opposing_moves(board, min_moves=2, min_pct=0.5):
@@ -229,107 +569,221 @@ def get_opposing_moves(board, min_moves=2, min_pct=0.5):
     if len(pass_pct) >= min_moves:
         return pass_pct[:10]
 
-    return sorted(table.keys(), key=lambda k: -table[k][0])[:min_moves]
+    return heapq.nlargest(min_moves, table, key=lambda k: table[k][0])
 
 
 def prune(q, amt):
     logging.info("Pruning %d...", len(q))
 
+    fens = [b.epd() for b in q]
+    prefetch_moves_tables(fens)
+
     deduped = []
     terminal = []
 
     totals = {}
-    for b in q:
-        if b.fen() in totals:
+    for b, fen in zip(q, fens):
+        if fen in totals:
             terminal.append(b)
             continue
 
-        tbl = get_moves_table(b)
+        tbl = get_moves_table(b, epd=fen)
         total = sum(c for _, c in tbl.values())
-        totals[b.fen()] = total
+        totals[fen] = total
 
         if total < 200:
             terminal.append(b)
             continue
         else:
-            deduped.append(b)
+            deduped.append((b, fen))
 
         if len(totals) % 20 == 0:
             logging.info("%d...", len(totals))
 
-    sorted_q = sorted(deduped, key=lambda b: -totals[b.fen()])
+    sorted_q = [b for b, _ in sorted(deduped, key=lambda bf: -totals[bf[1]])]
 
     logging.info("Pruned to %d. (%d dupes/uninteresting)", amt, len(terminal))
 
     return collections.deque(sorted_q[:amt]), sorted_q[amt:] + terminal
 
 
+# Runs in each pool worker. Engine processes, sockets and sqlite connections
+# can't be shared across a fork, so every worker opens its own and takes an
+# equal share of the cores and the hash. The parent keeps prefetching while
+# the workers run, so the rate limit is split one more way
+def init_worker(workers):
+    global client, explorer_cache, best_moves
+
+    start_engines(1, max(1, os.cpu_count() // workers), ENGINE_HASH // workers)
+    client = new_client()
+    explorer_cache = diskcache.Cache(explorer_cache.directory)
+    best_moves = diskcache.Cache(best_moves.directory)
+    share_rate_limit(workers + 1)
+
+
+# Our reply to each opposing move worth considering
+def expand(board, heuristic, color, find_best_move):
+    replies = []
+    strategy = (
+        getattr(heuristic, "__name__", None),
+        find_best_move.__name__,
+        EXPLORER_SOURCE,
+        BEST_MOVES_VERSION,
+    )
+
+    # engine-only strategies never need the reply's table, so aren't cut
+    # short by how often it's played
+    explorer_driven = heuristic is not None
+
+    for m in get_opposing_moves(board):
+        board.push(m)
+        try:
+            if explorer_driven and not get_moves_table(board, min_moves=MIN_REPLY_GAMES):
+                continue
+
+            key = (chess.polyglot.zobrist_hash(board), *strategy)
+
+            if (uci := best_moves.get(key)) is not None:
+                best = chess.Move.from_uci(uci)
+            else:
+                best = find_best_move(board, heuristic, color)
+                # expires with the explorer data it was chosen from
+                best_moves.set(key, best.uci(), expire=EXPLORER_CACHE_MAX_AGE)
+        finally:
+            board.pop()
+
+        replies.append((m, best))
+
+    return replies
+
+
+# Lines end on our move, and each is written out as soon as it's known to be
+# finished rather than held until the whole tree is built
+def emit_pgn(board, color):
+    if board.turn == color:
+        board.pop()
+
+    sys.stdout.write(f"{chess.pgn.Game.from_board(board)}\n\n")
+    sys.stdout.flush()
+
+    return board.ply()
+
+
 def build(heuristic, color, max_ply=MAX_PLY, prune_factor=20, find_best_move=find_best_move):
-    best_moves = {}
+    seen_positions = set()
 
     q = collections.deque()
-    terminal = []
-    ply = 0
+    depths = collections.Counter()
+    log_moves = logging.getLogger().isEnabledFor(logging.DEBUG)
 
     if color == chess.WHITE:
         board = chess.Board()
         best = find_best_move(board, heuristic, color)
         logging.info("q: %d, ply: %d, %s", len(q), board.ply(), board.san(best))
         board.push(best)
-        q.appendleft(board)
     else:
-        q.appendleft(chess.Board())
+        board = chess.Board()
+
+    seen_positions.add(chess.polyglot.zobrist_hash(board))
+    q.appendleft(board)
+
+    pool = None
+    expand_board = functools.partial(
+        expand, heuristic=heuristic, color=color, find_best_move=find_best_move
+    )
+
+    # Each board in a ply expands independently, so with several workers they
+    # are farmed out to processes that each run their own engine. Those take
+    # over the cores and hash, so ours are stopped until the pool is done
+    if WORKERS > 1:
+        stop_engines()
+        pool = multiprocessing.get_context("fork").Pool(
+            WORKERS, initializer=init_worker, initargs=(WORKERS,)
+        )
+        share_rate_limit(WORKERS + 1)
 
-    while q:
-        if (next_ply := q[-1].ply()) != ply:
-            ply = next_ply
-            q, t = prune(q, ply * prune_factor)
-            terminal.extend(t)
+    # Fetches tables for the next ply while the engine is busy with this one
+    background_prefetch = ThreadPoolExecutor(max_workers=BACKGROUND_PREFETCHES)
+    prefetching = []
 
-        if not q:
-            break
+    finished = False
+
+    try:
+        # breadth first, one ply at a time, so that each prune sees the whole
+        # frontier for that ply
+        while q:
+            if (ply := q[-1].ply()) > 0:
+                # the lru cache doesn't know about fetches still on their
+                # way, so let them land rather than have prune request them
+                # again
+                wait_for_futures(prefetching)
+                prefetching.clear()
+
+                q, t = prune(q, ply * prune_factor)
+                depths.update(emit_pgn(b, color) for b in t)
+
+            boards = list(reversed(q))
+            to_expand = [b for b in boards if b.ply() < max_ply + color]
+
+            if pool:
+                expanded = pool.imap(expand_board, to_expand)
+            else:
+                expanded = map(expand_board, to_expand)
 
-        board = q.pop()
+            next_ply = collections.deque()
 
-        logging.info("q: %d, ply: %d", len(q), board.ply())
+            for i, board in enumerate(boards):
+                board_ply = board.ply()
 
-        if board.ply() < max_ply + color and (opp_moves := get_opposing_moves(board)):
-            for m in opp_moves:
-                board_copy = board.copy()
-                board_copy.push(m)
+                logging.info("q: %d, ply: %d", len(boards) - i - 1, board_ply)
 
-                fen = board_copy.board_fen()
-                best = best_moves.get(fen)
+                if board_ply >= max_ply + color or not (replies := next(expanded)):
+                    depths[emit_pgn(board, color)] += 1
+                    continue
 
-                if not best:
-                    best = find_best_move(board_copy, heuristic, color)
-                    best_moves[fen] = best
+                for m, best in replies:
+                    board_copy = board.copy()
+                    board_copy.push(m)
 
-                logging.info("vs %s... %s", board.san(m), board_copy.san(best))
+                    # SAN needs legal move generation, so only build it when logged
+                    if log_moves:
+                        logging.debug("vs %s... %s", board.san(m), board_copy.san(best))
 
-                board_copy.push(best)
+                    board_copy.push(best)
 
-                q.appendleft(board_copy)
-        else:
-            terminal.append(board)
+                    # a transposition of a line we're already exploring ends here
+                    if (key := chess.polyglot.zobrist_hash(board_copy)) in seen_positions:
+                        depths[emit_pgn(board_copy, color)] += 1
+                        continue
 
-    depths = {}
-    for b in terminal:
-        if b.turn == color:
-            b.pop()
+                    seen_positions.add(key)
+                    next_ply.appendleft(board_copy)
 
-        depths[b.ply()] = depths.get(b.ply(), 0) + 1
-        game = chess.pgn.Game()
-        moves = b.move_stack
+                    if board_copy.ply() < max_ply + color:
+                        prefetching.append(
+                            background_prefetch.submit(prefetch_moves_table, board_copy.epd())
+                        )
 
-        node = game.add_main_variation(moves[0])
+            q = next_ply
 
-        for m in moves[1:]:
-            node = node.add_main_variation(m)
+        finished = True
+    finally:
+        # prefetches still queued are of no use once the tree is done
+        background_prefetch.shutdown(cancel_futures=True)
+
+        if pool:
+            # on an error or ctrl-c, don't wait for the rest of the ply's
+            # searches before reporting it
+            if finished:
+                pool.close()
+            else:
+                pool.terminate()
 
-        print(game, end="\n\n")
+            pool.join()
+            start_main_engines()
+            share_rate_limit(1)
 
-    logging.info("Depths: %s", depths)
+    logging.info("Depths: %s", dict(depths))
 
 
 WHATS = {
@@ -356,4 +810,4 @@ try:
     logging.info("Building for %s", args)
     build(**args)
 finally:
-    engine.quit()
+    stop_engines()
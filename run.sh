@@ -4,7 +4,7 @@ set -e
 
 docker build . -t chess-exp:latest
 
-mkdir -p out
+mkdir -p out cache
 
 what=$1
 
@@ -15,5 +15,5 @@ fi
 
 for w in $what
 do
-  docker run chess-exp:latest $w $2 > out/$w.pgn
+  docker run -v "$(pwd)/cache:/cache" -e EXPLORER_CACHE=/cache -e WORKERS="${WORKERS:-1}" -e ENGINES="${ENGINES:-1}" -e EXPLORER_SOURCE="${EXPLORER_SOURCE:-api}" chess-exp:latest $w $2 > out/$w.pgn
 done